@@ -1,10 +1,16 @@
 import os
 import io
+import asyncio
 import base64
 import re
-from PIL import Image, ImageChops
+import functools
+import random
+import hashlib
+from collections import OrderedDict
+from PIL import Image
 import numpy as np
-import requests
+import httpx
+import orjson
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
@@ -16,6 +22,33 @@ OCR_API_URL = 'https://api.ocr.space/parse/image'
 TEMPLATE_WIDTH = 1100
 TEMPLATE_HEIGHT = 701
 
+# Largest upload accepted, in pixels; PIL also refuses to decode anything far beyond it
+MAX_IMAGE_PIXELS = 25_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Per-channel difference from the background colour that counts as content
+TRIM_THRESHOLD = 100
+
+# Blank pixels between stacked crops so OCR never merges lines across fields
+STITCH_ROW_GAP = 10
+
+# 'space' sends crops to the OCR.space API, 'local' runs RapidOCR in-process
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'space').lower()
+if OCR_BACKEND not in ('space', 'local'):
+    raise RuntimeError(f"Unknown OCR_BACKEND {OCR_BACKEND!r}, expected 'space' or 'local'")
+
+# Stitch all crops into one OCR request; set OCR_BATCH=false to OCR each field separately
+OCR_BATCH = os.getenv('OCR_BATCH', 'true').lower() == 'true'
+# Upper bound on in-flight per-field OCR requests, to respect OCR.space rate limits
+OCR_CONCURRENCY = 8
+OCR_MAX_ATTEMPTS = 3
+# Transient OCR API responses worth retrying
+OCR_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# OCR.space FileParseExitCode values for engine errors and timeouts, also worth retrying
+OCR_RETRY_EXIT_CODES = (-10, -20, -99)
+# Number of distinct crops whose OCR text is kept in memory
+OCR_CACHE_SIZE = 4096
+
 # SVG field mapping with coordinates
 svg_mapped_fields = {
     'Employee SSN': (0.5, 0.5, 235, 49),
@@ -46,8 +79,74 @@ svg_mapped_fields = {
     '19 Local income tax': (833.5, 514.5, 159, 48),
 }
 
+# Integer crop boxes (x1, y1, x2, y2), in svg_mapped_fields order
+_FIELD_BOXES = np.array(
+    [(int(x), int(y), int(x + w), int(y + h)) for (x, y, w, h) in svg_mapped_fields.values()],
+    dtype=np.int32,
+)
+# The same boxes paired with their field names, as plain int tuples
+_FIELD_CROP_BOXES = list(zip(svg_mapped_fields, map(tuple, _FIELD_BOXES.tolist())))
+
+# Stitched canvas geometry: every field crop fits in one row of this pitch and width
+_STITCH_ROW_PITCH = int((_FIELD_BOXES[:, 3] - _FIELD_BOXES[:, 1]).max()) + STITCH_ROW_GAP
+_STITCH_WIDTH = int((_FIELD_BOXES[:, 2] - _FIELD_BOXES[:, 0]).max())
+
+# Fields whose value is a dollar amount
+money_fields = frozenset({
+    '1 Wages, tips, other compensation', '2 Federal income tax withheld',
+    '3 Social security wages', '4 Social security tax withheld',
+    '5 Medical wages and tips', '6 Medicare tax withheld',
+})
+
+# Regexes used while cleaning OCR output, compiled once at import
+_WS_RE = re.compile(r'\s+')
+_BADCHAR_RE = re.compile(r'[^\w\s.,$\-]')
+_MONEY_RE = re.compile(r'\$\d{1,3}(?:,\d{3})*(?:\.\d{2})?')
+_DATA_URI_RE = re.compile('^data:image/.+;base64,')
+
+# Case-insensitive literal pattern for a field label, compiled once per label
+@functools.lru_cache(maxsize=512)
+def _field_name_re(name):
+    return re.compile(re.escape(name), re.IGNORECASE)
+
 app = FastAPI()
 
+# Pooled OCR clients, one per running event loop. Pooled connections are bound to the
+# loop that opened them, and serverless runtimes may start a new loop per request.
+_ocr_clients = {}
+
+# Function to get the OCR client for the running event loop, so connections and TLS
+# sessions are reused across requests served by the same loop
+def get_ocr_client():
+    loop = asyncio.get_running_loop()
+    client = _ocr_clients.get(loop)
+    if client is None:
+        # Clients of closed loops can no longer be used or closed, so just drop them
+        for stale_loop in [other for other in list(_ocr_clients) if other.is_closed()]:
+            _ocr_clients.pop(stale_loop, None)
+        client = _ocr_clients[loop] = httpx.AsyncClient(
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+        )
+    return client
+
+@app.on_event("shutdown")
+async def close_ocr_client():
+    client = _ocr_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+# In-process OCR engine, only loaded when the local backend is selected
+local_ocr = None
+if OCR_BACKEND == 'local':
+    # Imported here so 'space' deployments never load onnxruntime and OpenCV
+    try:
+        from rapidocr_onnxruntime import RapidOCR
+    except ImportError:
+        raise RuntimeError("OCR_BACKEND=local requires the rapidocr_onnxruntime package")
+    local_ocr = RapidOCR()
+
 # CORS settings
 app.add_middleware(
     CORSMiddleware,
@@ -59,64 +158,162 @@ app.add_middleware(
 
 # Utility function to resize the image
 def resize_image(image, target_width, target_height):
-    return image.resize((target_width, target_height), Image.BILINEAR)
+    if image.size == (target_width, target_height):
+        return image
+    # Area averaging is both faster and sharper than bilinear when shrinking a scan
+    if image.width >= target_width and image.height >= target_height:
+        resample = Image.Resampling.BOX
+    else:
+        resample = Image.Resampling.BILINEAR
+    return image.resize((target_width, target_height), resample)
+
+# Mask of pixels that differ from the background colour by more than TRIM_THRESHOLD
+def _content_mask(pixels, bg):
+    # Absolute per-channel difference from the background, without leaving uint8
+    diff = np.maximum(pixels, bg) - np.minimum(pixels, bg)
+    mask = diff > TRIM_THRESHOLD
+    return mask.any(axis=-1) if np.ndim(bg) else mask
 
 # Utility function to trim whitespace from the image
 def trim_whitespace(image):
-    bg = Image.new(image.mode, image.size, image.getpixel((0, 0)))
-    diff = ImageChops.difference(image, bg)
-    diff = ImageChops.add(diff, diff, 2.0, -100)
-    bbox = diff.getbbox()
-    if bbox:
-        return image.crop(bbox)
-    return image
+    arr = np.asarray(image)
+    bg = arr[0, 0]
+    # Content touching all four edges means there is no margin to trim
+    edges = (arr[0], arr[-1], arr[:, 0], arr[:, -1])
+    if all(_content_mask(edge, bg).any() for edge in edges):
+        return image
+
+    mask = _content_mask(arr, bg)
+    rows = mask.any(axis=1)
+    if not rows.any():
+        return image
+    cols = mask.any(axis=0)
+    y0, y1 = rows.argmax(), len(rows) - rows[::-1].argmax()
+    x0, x1 = cols.argmax(), len(cols) - cols[::-1].argmax()
+    return image.crop((int(x0), int(y0), int(x1), int(y1)))
+
+# Decode an OCR.space response body, which must be a JSON object
+def _parse_ocr_space_response(response):
+    try:
+        result = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        result = None
+    if not isinstance(result, dict):
+        raise HTTPException(status_code=500, detail="OCR API error: malformed response")
+    return result
+
+# OCR.space reports failures such as E101 timeouts with HTTP 200, so a successful
+# status alone does not mean the image was parsed. Returns None on success, otherwise
+# the error message and whether it is worth retrying.
+def _ocr_space_error(result):
+    parsed_results = result.get('ParsedResults')
+    parsed = parsed_results[0] if isinstance(parsed_results, list) and parsed_results else {}
+    if not isinstance(parsed, dict):
+        parsed = {}
+    exit_code = parsed.get('FileParseExitCode')
+    if not result.get('IsErroredOnProcessing') and exit_code == 1:
+        return None
+
+    message = result.get('ErrorMessage') or parsed.get('ErrorMessage') or parsed.get('ErrorDetails')
+    if isinstance(message, list):
+        message = "; ".join(map(str, message))
+    message = str(message or "image could not be processed")
+    # Engine errors and timeouts are transient; validation errors or a rejected key are not
+    retryable = exit_code in OCR_RETRY_EXIT_CODES or 'E101' in message
+    return message, retryable
 
 # Function to send image to OCR API
-def ocr_space_request(cropped_img):
+async def post_to_ocr_space(client, image, **options):
     buffer = io.BytesIO()
-    cropped_img.save(buffer, format="PNG")
-    img_str = base64.b64encode(buffer.getvalue()).decode()
+    image.save(buffer, format="JPEG", quality=85, optimize=False)
+    files = {'file': ('crop.jpg', buffer.getvalue(), 'image/jpeg')}
 
     payload = {
         'apikey': OCR_API_KEY,
-        'base64Image': 'data:image/png;base64,' + img_str,
         'isTable': True,
-        'OCREngine': 2
+        'OCREngine': 2,
+        **options
     }
 
     try:
-        response = requests.post(OCR_API_URL, data=payload)
-        response.raise_for_status()
-        result = response.json()
-
-        if 'ParsedResults' in result and result['ParsedResults']:
-            return result['ParsedResults'][0]['ParsedText']
-        else:
-            return ""
-    except requests.exceptions.RequestException as e:
+        for attempt in range(OCR_MAX_ATTEMPTS):
+            last_attempt = attempt == OCR_MAX_ATTEMPTS - 1
+            try:
+                response = await client.post(OCR_API_URL, data=payload, files=files)
+            except httpx.TransportError:
+                if last_attempt:
+                    raise
+            else:
+                if response.status_code not in OCR_RETRY_STATUS_CODES or last_attempt:
+                    response.raise_for_status()
+                    result = _parse_ocr_space_response(response)
+                    error = _ocr_space_error(result)
+                    if error is None:
+                        return result['ParsedResults'][0]
+                    message, retryable = error
+                    if not retryable or last_attempt:
+                        raise HTTPException(status_code=500, detail=f"OCR API error: {message}")
+            # Exponential backoff with jitter so concurrent field requests don't retry in lockstep
+            await asyncio.sleep((2 ** attempt) * 0.5 + random.uniform(0, 0.25))
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"OCR API error: {e}")
 
+# Function to OCR a single crop, bounded by the per-request semaphore
+async def ocr_space_request_async(client, sem, cropped_img):
+    async with sem:
+        parsed = await post_to_ocr_space(client, Image.fromarray(cropped_img))
+    return parsed.get('ParsedText', "")
+
+# Function to OCR field crops in one request by stacking them into a single image.
+# Each crop gets a row of the precomputed pitch, so every returned line is mapped
+# back to its crop by integer-dividing the line's MinTop by the row pitch.
+async def ocr_space_batch_request(client, crops):
+    keys = list(crops)
+    if not keys:
+        return {}
+    row_pitch = _STITCH_ROW_PITCH
+
+    # One preallocated white canvas; each crop is copied straight into its row
+    first = crops[keys[0]]
+    canvas = np.full((row_pitch * len(keys), _STITCH_WIDTH) + first.shape[2:], 255, dtype=first.dtype)
+    for row, key in enumerate(keys):
+        height, width = crops[key].shape[:2]
+        top = row * row_pitch
+        np.copyto(canvas[top:top + height, :width], crops[key])
+
+    parsed = await post_to_ocr_space(client, Image.fromarray(canvas), isOverlayRequired=True)
+    lines_by_key = {key: [] for key in keys}
+    for line in parsed.get('TextOverlay', {}).get('Lines', []):
+        row = int(line['MinTop'] // row_pitch)
+        if 0 <= row < len(keys):
+            lines_by_key[keys[row]].append(line['LineText'])
+
+    return {key: "\n".join(lines) for key, lines in lines_by_key.items()}
+
+# Function to OCR all crops with the in-process engine, no network round-trip
+def ocr_local_batch(crops):
+    texts = {}
+    for key, crop in crops.items():
+        result, _ = local_ocr(crop)
+        texts[key] = "\n".join(text for _, text, _ in result or [])
+    return texts
+
 # Cleaning the extracted text
 def clean_extracted_text(field_name, extracted_text):
     extracted_text = extracted_text.strip()
     unwanted_phrases = ["For Official Use Only", "VOID"]
     for phrase in unwanted_phrases:
         extracted_text = extracted_text.replace(phrase, "")
-    extracted_text = re.sub(re.escape(field_name), '', extracted_text, flags=re.IGNORECASE)
-
-    money_fields = [
-        "Wages, tips, other compensation", "Federal income tax withheld",
-        "Social security wages", "Social security tax withheld",
-        "Medical wages and tips", "Medicare tax withheld"
-    ]
+    extracted_text = _field_name_re(field_name).sub('', extracted_text)
 
-    if any(money_field in field_name for money_field in money_fields):
-        money_match = re.search(r'\$\d{1,3}(?:,\d{3})*(?:\.\d{2})?', extracted_text)
+    if field_name in money_fields:
+        money_match = _MONEY_RE.search(extracted_text)
+        # A money match is only '$', digits, ',' and '.', so it is already clean
         if money_match:
-            extracted_text = money_match.group(0)
+            return money_match.group(0)
 
-    extracted_text = re.sub(r'\s+', ' ', extracted_text)
-    extracted_text = re.sub(r'[^\w\s\.\,\$\-]', '', extracted_text)
+    extracted_text = _WS_RE.sub(' ', extracted_text)
+    extracted_text = _BADCHAR_RE.sub('', extracted_text)
 
     return extracted_text.strip()
 
@@ -128,17 +325,90 @@ def post_process_extracted_data(data):
         processed_data[field] = cleaned_value
     return processed_data
 
+# Raw OCR text keyed by crop content, least recently used first
+ocr_cache = OrderedDict()
+
+# Key identifying a crop by its shape and pixel content
+def _crop_key(crop):
+    return crop.shape, hashlib.blake2b(crop, digest_size=16).digest()
+
+# Function to OCR crops with the configured backend
+async def ocr_crops(crops):
+    if OCR_BACKEND == 'local':
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, ocr_local_batch, crops)
+    client = get_ocr_client()
+    if OCR_BATCH:
+        return await ocr_space_batch_request(client, crops)
+    sem = asyncio.Semaphore(OCR_CONCURRENCY)
+    tasks = [ocr_space_request_async(client, sem, crop) for crop in crops.values()]
+    return dict(zip(crops, await asyncio.gather(*tasks)))
+
 # Function to extract text from SVG-mapped fields in the image
-def extract_text_from_svg_fields(image):
+async def extract_text_from_svg_fields(image):
+    # Read the pixels once; each crop is a contiguous copy of a slice of this array
+    pixels = np.asarray(image)
+    crop_keys = {}
+    texts = {}
+    pending = {}
+    for field_name, (x1, y1, x2, y2) in _FIELD_CROP_BOXES:
+        crop = np.ascontiguousarray(pixels[y1:y2, x1:x2])
+        key = crop_keys[field_name] = _crop_key(crop)
+        if key in texts or key in pending:
+            continue
+        if key in ocr_cache:
+            ocr_cache.move_to_end(key)
+            texts[key] = ocr_cache[key]
+        else:
+            pending[key] = crop
+
+    # Only crops not seen before go to OCR, and identical crops are sent once.
+    # A failed OCR call raises, so only successfully parsed text reaches the cache.
+    if pending:
+        for key, text in (await ocr_crops(pending)).items():
+            texts[key] = ocr_cache[key] = text
+            if len(ocr_cache) > OCR_CACHE_SIZE:
+                ocr_cache.popitem(last=False)
+
     extracted_data = {}
-    for field_name, coords in svg_mapped_fields.items():
-        x, y, width, height = coords
-        cropped_img = image.crop((x, y, x + width, y + height))
-        extracted_text = ocr_space_request(cropped_img)
-        cleaned_text = clean_extracted_text(field_name, extracted_text)
-        extracted_data[field_name] = cleaned_text
+    for field_name, key in crop_keys.items():
+        extracted_data[field_name] = clean_extracted_text(field_name, texts[key])
     return extracted_data
 
+# Function to decode an uploaded image
+def open_image(stream):
+    try:
+        image = Image.open(stream)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image too large.")
+    # Image.open only reads the header, so this rejects oversize scans before decoding
+    if image.size[0] * image.size[1] > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail="Image too large.")
+    # Let libjpeg downscale while decoding; a no-op for PNG
+    image.draft("RGB", (TEMPLATE_WIDTH * 2, TEMPLATE_HEIGHT * 2))
+    return image.convert("RGB")
+
+# Function to run the extraction pipeline shared by both endpoints
+async def process_w2_image(stream):
+    # Decoding, trimming and resizing are CPU-bound, so keep them off the event loop
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(None, open_image, stream)
+    # Trim on colour so light-coloured form lines still count as content
+    trimmed_image = await loop.run_in_executor(None, trim_whitespace, image)
+    # OCR of printed text gains nothing from colour, so everything after the trim uses one channel
+    gray_image = await loop.run_in_executor(None, trimmed_image.convert, "L")
+    resized_image = await loop.run_in_executor(None, resize_image, gray_image, TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
+    extracted_data = await extract_text_from_svg_fields(resized_image)
+    cleaned_data = post_process_extracted_data(extracted_data)
+
+    headers = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
+        "Access-Control-Allow-Headers": "*"
+    }
+
+    return JSONResponse(content={"extracted_data": cleaned_data}, headers=headers)
+
 # Health check endpoint
 @app.get("/")
 def message():
@@ -152,20 +422,10 @@ async def extract_w2_data(file: UploadFile = File(...)):
         if file.content_type not in ["image/png", "image/jpeg"]:
             raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PNG or JPEG image.")
 
-        image = Image.open(file.file).convert("RGB")
-        trimmed_image = trim_whitespace(image)
-        resized_image = resize_image(trimmed_image, TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
-        extracted_data = extract_text_from_svg_fields(resized_image)
-        cleaned_data = post_process_extracted_data(extracted_data)
-
-        headers = {
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
-            "Access-Control-Allow-Headers": "*"
-        }
-
-        return JSONResponse(content={"extracted_data": cleaned_data}, headers=headers)
+        return await process_w2_image(file.file)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing the image: {e}")
 
@@ -174,24 +434,12 @@ async def extract_w2_data(file: UploadFile = File(...)):
 async def extract_w2_data_base64(base64_image: str = Form(...)):
     try:
         # Remove the prefix 'data:image/png;base64,' from the base64 string
-        image_data = re.sub('^data:image/.+;base64,', '', base64_image)
-        
-        # Decode the base64 string and open the image
-        image = Image.open(io.BytesIO(base64.b64decode(image_data))).convert("RGB")
-        
-        # Call your image processing functions here
-        trimmed_image = trim_whitespace(image)
-        resized_image = resize_image(trimmed_image, TEMPLATE_WIDTH, TEMPLATE_HEIGHT)
-        extracted_data = extract_text_from_svg_fields(resized_image)
-        cleaned_data = post_process_extracted_data(extracted_data)
-
-        headers = {
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
-            "Access-Control-Allow-Headers": "*"
-        }
-
-        return JSONResponse(content={"extracted_data": cleaned_data}, headers=headers)
+        image_data = _DATA_URI_RE.sub('', base64_image)
+
+        # Decode the base64 string and process the image
+        return await process_w2_image(io.BytesIO(base64.b64decode(image_data)))
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing the image: {e}")